@@ -1,18 +1,34 @@
 import os
+import atexit
+import base64
+import hashlib
+import io
+import json
 import logging
+import math
+import queue
+import random
+import re
 import sqlite3
-import tempfile
+import threading
+import time
 import zipfile
 import xml.etree.ElementTree as ET
 import uuid
-from datetime import datetime
-from difflib import SequenceMatcher
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import BinaryIO, Optional
 
-from copyleaks import Copyleaks
-from copyleaks.models.scan_properties import ScanProperties, Webhooks
-from copyleaks.models.source import SourceText
+import numpy as np
+import orjson
+from datasketch import MinHash, MinHashLSH
+import requests
+from rapidfuzz import fuzz, process
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, abort, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telegram import Bot, Update
 from telegram.ext import Dispatcher, CommandHandler, MessageHandler, Filters
 
@@ -29,7 +45,31 @@ COPYLEAKS_API_KEY = os.getenv("COPYLEAKS_API_KEY")
 
 DB_PATH = "submissions.db"
 LOCAL_SIMILARITY_THRESHOLD = 0.7
+# Вне этого диапазона длин (после нормализации) поиск похожих работ не ведётся:
+# у коротких текстов ratio шумный. Длинные сравниваются линейным Жаккаром
+# (см. LONG_TEXT_THRESHOLD), поэтому верхняя граница лишь отсекает заведомо
+# аномальные файлы: на 1 млн символов (~500 страниц) подготовка занимает ~2 с.
+# Точные копии находятся при любой длине
+LOCAL_SCAN_MIN_LEN = int(os.getenv("LOCAL_SCAN_MIN_LEN", "200"))
+LOCAL_SCAN_MAX_LEN = int(os.getenv("LOCAL_SCAN_MAX_LEN", "1000000"))
 INTERNET_SIMILARITY_THRESHOLD = 20.0  # % совпадений
+# Сколько секунд результат Copyleaks для того же текста переиспользуется без нового скана
+INTERNET_SCORE_TTL = float(os.getenv("INTERNET_SCORE_TTL", "86400"))
+FTS_CANDIDATES_LIMIT = 50  # сколько кандидатов BM25 сверяем посимвольно
+FTS_MAX_TERMS = 32  # сколько самых длинных слов идёт в MATCH-запрос
+MINHASH_NUM_PERM = 128
+MINHASH_SCHEME = "affine32"  # схема перестановок datasketch; значения хранятся как uint32
+SHINGLE_SIZE = 5  # длина символьного шингла для MinHash
+# Длинные тексты сравниваются по Жаккару шинглов из слов: линейно и без
+# квадратичной посимвольной сверки
+LONG_TEXT_THRESHOLD = 1000
+WORD_SHINGLE_SIZE = 3
+# Порог Жаккара для длинных текстов. Шкала не та, что у ratio: замена каждого
+# десятого слова даёт ratio ~0.92, но Жаккар ~0.55; 0.3 — заменено около четверти слов
+LONG_TEXT_JACCARD_THRESHOLD = 0.3
+# Порог LSH ниже порогов сходства: LSH лишь отбирает кандидатов, и правка
+# каждого пятого слова опускает Жаккар символьных шинглов до ~0.6
+LSH_THRESHOLD = 0.5
 
 # --------------------------------------------
 #  Логирование
@@ -43,8 +83,77 @@ logger = logging.getLogger(__name__)
 # --------------------------------------------
 #  Локальная БД (SQLite)
 # --------------------------------------------
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+# Одно соединение на процесс; воркеры Dispatcher обращаются к нему под замком
+_db = None
+_db_lock = threading.Lock()
+# LSH-индекс MinHash-подписей (id работы -> подпись); строится в init_db
+_lsh = MinHashLSH(threshold=LSH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+# Перестановки зависят только от seed; генерация на каждый MinHash — основная
+# цена восстановления подписи из БД, поэтому считаем их один раз
+_MINHASH_PERMUTATIONS = MinHash(num_perm=MINHASH_NUM_PERM, scheme=MINHASH_SCHEME).permutations
+
+# Очередь записи: save_submission только кладёт строку, пишет один поток
+WRITE_BATCH_SIZE = 128
+BACKFILL_BATCH_SIZE = 500
+_write_queue = queue.Queue()
+_writer = None
+_WRITER_STOP = object()  # метка в очереди: потоку записи пора завершиться
+# Число сохранённых работ; меняется только под _db_lock
+_submission_count = 0
+
+# Колонки, вычисляемые из text при сохранении (см. submission_features)
+DERIVED_COLUMNS = (
+    ("text_hash", "BLOB"),
+    ("minhash", "BLOB"),
+    ("norm_text", "TEXT"),
+    ("norm_len", "INTEGER"),
+    ("word_shingles", "BLOB"),
+)
+_DERIVED_NAMES = [name for name, _ in DERIVED_COLUMNS]
+# Версия схемы (PRAGMA user_version):
+# 1 — text_hash считается по нормализованному тексту
+# 2 — scanned_at: время скана Copyleaks, чей результат записан в internet_score
+SCHEMA_VERSION = 2
+
+# Порядок полей строки из save_submission: эти колонки, затем DERIVED_COLUMNS
+SUBMISSION_COLUMNS = ("user_id", "username", "text", "ts", "internet_score", "scanned_at")
+_MINHASH_POS = len(SUBMISSION_COLUMNS) + _DERIVED_NAMES.index("minhash")
+
+INSERT_SUBMISSION_SQL = (
+    "INSERT INTO submissions "
+    f"({', '.join(SUBMISSION_COLUMNS + tuple(_DERIVED_NAMES))}) "
+    f"VALUES ({', '.join('?' * (len(SUBMISSION_COLUMNS) + len(_DERIVED_NAMES)))})"
+)
+
+
+def get_db() -> sqlite3.Connection:
+    """
+    Возвращает общее соединение с БД (autocommit, WAL), открывая его при первом вызове.
+    """
+    global _db
+    if _db is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _db = conn
+    return _db
+
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    with _db_lock:
+        _init_schema(get_db())
+    start_writer()
+
+
+def _init_schema(conn: sqlite3.Connection):
     conn.execute("""
         CREATE TABLE IF NOT EXISTS submissions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -52,78 +161,733 @@ def init_db():
             username TEXT,
             text TEXT NOT NULL,
             ts TEXT NOT NULL,
-            internet_score REAL
+            internet_score REAL,
+            scanned_at TEXT,
+            text_hash BLOB,
+            minhash BLOB,
+            norm_text TEXT,
+            norm_len INTEGER,
+            word_shingles BLOB
+        )
+    """
+    )
+    # Миграция БД, созданных до появления производных колонок
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(submissions)")}
+    for column, column_type in DERIVED_COLUMNS + (("scanned_at", "TEXT"),):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE submissions ADD COLUMN {column} {column_type}")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # Хэши старого формата сбрасываем — их пересчитает дозаполнение ниже
+        conn.execute("UPDATE submissions SET text_hash = NULL")
+    if version < 2:
+        # Раньше каждая строка со счётом сканировалась сама, в момент сохранения
+        conn.execute("UPDATE submissions SET scanned_at = ts WHERE internet_score IS NOT NULL")
+    if version < SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    # Дозаполняем пачками по id, чтобы не держать в памяти все тексты сразу
+    select_missing = (
+        "SELECT id, text FROM submissions WHERE id > ? AND ("
+        + " OR ".join(f"{name} IS NULL" for name in _DERIVED_NAMES)
+        + ") ORDER BY id LIMIT ?"
+    )
+    update_derived = (
+        "UPDATE submissions SET "
+        + ", ".join(f"{name} = ?" for name in _DERIVED_NAMES)
+        + " WHERE id = ?"
+    )
+    last_id = 0
+    while True:
+        missing = conn.execute(select_missing, (last_id, BACKFILL_BATCH_SIZE)).fetchall()
+        if not missing:
+            break
+        conn.execute("BEGIN")
+        conn.executemany(update_derived, (submission_features(text) + (row_id,) for row_id, text in missing))
+        conn.execute("COMMIT")
+        last_id = missing[-1][0]
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_text_hash ON submissions(text_hash)")
+    # Полнотекстовый индекс (external content) поверх submissions.text.
+    # Триграммы дают совпадение по подстроке: слово из запроса находит и его
+    # словоформы с другим окончанием («пушкин» -> «пушкина»)
+    fts_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'submissions_fts'"
+    ).fetchone()
+    if fts_sql and "trigram" not in fts_sql[0]:
+        # Индекс со старым токенизатором пересоздаём целиком
+        conn.executescript("""
+            DROP TRIGGER IF EXISTS submissions_ai;
+            DROP TRIGGER IF EXISTS submissions_ad;
+            DROP TRIGGER IF EXISTS submissions_au;
+            DROP TABLE submissions_fts;
+        """
         )
+        fts_sql = None
+    conn.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS submissions_fts USING fts5(
+            text,
+            content='submissions',
+            content_rowid='id',
+            tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS submissions_ai AFTER INSERT ON submissions BEGIN
+            INSERT INTO submissions_fts(rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS submissions_ad AFTER DELETE ON submissions BEGIN
+            INSERT INTO submissions_fts(submissions_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS submissions_au AFTER UPDATE OF text ON submissions BEGIN
+            INSERT INTO submissions_fts(submissions_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            INSERT INTO submissions_fts(rowid, text) VALUES (new.id, new.text);
+        END;
     """
     )
-    conn.commit()
-    conn.close()
+    if not fts_sql:
+        # Индексируем работы, сохранённые до появления (или смены) FTS
+        conn.execute("INSERT INTO submissions_fts(submissions_fts) VALUES ('rebuild')")
+    global _submission_count
+    _submission_count = conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+    with _lsh.insertion_session() as session:
+        for row_id, blob in conn.execute("SELECT id, minhash FROM submissions"):
+            if row_id not in _lsh:
+                session.insert(row_id, minhash_from_blob(blob))
+
+
+def normalize_text(text: str) -> str:
+    """
+    Нормализованная форма для сравнения: нижний регистр, пробелы схлопнуты.
+    """
+    # split()/join быстрее re.sub(r"\s+") и сразу убирает пробелы по краям
+    return " ".join(text.lower().split())
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
 
 
-def save_submission(user_id: int, username: str, text: str, internet_score: float):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute(
-        "INSERT INTO submissions (user_id, username, text, ts, internet_score) VALUES (?, ?, ?, ?, ?)",
-        (user_id, username, text, datetime.utcnow().isoformat(), internet_score)
+def prepare_text(text: str) -> tuple:
+    """
+    Нормализует текст один раз на работу: (norm_text, text_hash) для поиска
+    дубликатов, локальной проверки и склейки одинаковых сканов Copyleaks.
+    """
+    norm = normalize_text(text)
+    return norm, text_hash(norm)
+
+
+def text_minhash(text: str) -> MinHash:
+    """
+    MinHash-подпись по множеству символьных шинглов текста.
+    """
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)} or {text}
+    m = MinHash(num_perm=MINHASH_NUM_PERM, permutations=_MINHASH_PERMUTATIONS, scheme=MINHASH_SCHEME)
+    # Один векторный проход numpy по всем шинглам вместо update() на каждый
+    m.update_batch([shingle.encode("utf-8") for shingle in shingles])
+    return m
+
+
+def word_shingle_hashes(norm: str) -> np.ndarray:
+    """
+    Отсортированные уникальные 64-битные хэши шинглов из WORD_SHINGLE_SIZE слов.
+    """
+    words = norm.split()
+    shingles = {
+        " ".join(words[i:i + WORD_SHINGLE_SIZE])
+        for i in range(len(words) - WORD_SHINGLE_SIZE + 1)
+    }
+    hashes = [
+        int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "little")
+        for sh in shingles
+    ]
+    return np.unique(np.array(hashes, dtype=np.uint64))
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    common = np.intersect1d(a, b, assume_unique=True).size
+    union = a.size + b.size - common
+    return common / union if union else 0.0
+
+
+def minhash_to_blob(m: MinHash) -> bytes:
+    return m.digest().tobytes()
+
+
+def minhash_from_blob(blob: bytes) -> MinHash:
+    return MinHash(
+        num_perm=MINHASH_NUM_PERM,
+        hashvalues=np.frombuffer(blob, dtype=np.uint32),
+        permutations=_MINHASH_PERMUTATIONS,
+        scheme=MINHASH_SCHEME
     )
-    conn.commit()
-    conn.close()
-
-
-def calculate_max_similarity_locally(new_text: str):
-    conn = sqlite3.connect(DB_PATH)
-    rows = conn.execute(
-        "SELECT user_id, username, text FROM submissions"
-    ).fetchall()
-    conn.close()
-    best_ratio, best_user = 0.0, None
-    for user_id, username, old_text in rows:
-        ratio = SequenceMatcher(None, new_text, old_text).ratio()
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_user = username or str(user_id)
-    return best_ratio, best_user
+
+
+def submission_features(text: str) -> tuple:
+    """
+    Производные колонки работы, считаются один раз при сохранении:
+    (text_hash, minhash, norm_text, norm_len, word_shingles).
+    """
+    norm, digest = prepare_text(text)
+    return (
+        digest, minhash_to_blob(text_minhash(norm)), norm, len(norm),
+        word_shingle_hashes(norm).tobytes()
+    )
+
+
+def save_submission(user_id: int, username: str, text: str, internet_score: float,
+                    scanned_at: str = None):
+    """
+    Ставит работу в очередь записи; в БД её сохраняет фоновый поток пачками.
+    scanned_at — время скана, давшего internet_score (по умолчанию сейчас);
+    при переиспользовании чужого результата передаётся время того скана.
+    """
+    now = datetime.utcnow().isoformat()
+    if internet_score is None:
+        scanned_at = None
+    elif scanned_at is None:
+        scanned_at = now
+    row = (user_id, username, text, now, internet_score, scanned_at) + submission_features(text)
+    _write_queue.put(row)
+
+
+def _flush_submissions(batch: list):
+    """
+    Записывает пачку работ одной транзакцией и добавляет их подписи в LSH.
+    """
+    global _submission_count
+    with _db_lock:
+        conn = get_db()
+        conn.execute("BEGIN")
+        try:
+            # execute по строке, а не executemany: нужен id каждой записи для LSH
+            row_ids = [conn.execute(INSERT_SUBMISSION_SQL, row).lastrowid for row in batch]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        _submission_count += len(row_ids)
+        for row_id, row in zip(row_ids, batch):
+            _lsh.insert(row_id, minhash_from_blob(row[_MINHASH_POS]))
+
+
+def _drain_write_queue(block: bool) -> int:
+    """
+    Записывает до WRITE_BATCH_SIZE работ из очереди. Возвращает их число
+    или -1, если в пачке была метка остановки (работы до и после неё записаны).
+    """
+    batch = [_write_queue.get()] if block else []
+    try:
+        while len(batch) < WRITE_BATCH_SIZE:
+            batch.append(_write_queue.get_nowait())
+    except queue.Empty:
+        pass
+    rows = [row for row in batch if row is not _WRITER_STOP]
+    if rows:
+        try:
+            _flush_submissions(rows)
+        except Exception:
+            logger.exception("Не удалось сохранить %d работ", len(rows))
+    return -1 if len(rows) < len(batch) else len(rows)
+
+
+def _writer_loop():
+    while _drain_write_queue(block=True) >= 0:
+        pass
+
+
+def start_writer():
+    global _writer
+    if _writer is None:
+        _writer = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+        _writer.start()
+        atexit.register(stop_writer)
+
+
+def stop_writer():
+    """
+    Штатная остановка: дожидается пачки, которую пишет поток записи, и
+    дописывает очередь до конца — пользователям эти работы уже подтверждены.
+    """
+    global _writer
+    if _writer is not None:
+        _write_queue.put(_WRITER_STOP)
+        _writer.join()
+        _writer = None
+    while _drain_write_queue(block=False) > 0:
+        pass
+
+
+def build_fts_query(text: str) -> str:
+    """
+    Строит MATCH-запрос FTS5: самые длинные слова текста через OR.
+    """
+    # Короче трёх символов триграммный индекс не ищет
+    words = {w for w in re.findall(r"\w+", text.lower()) if len(w) >= 3}
+    longest = sorted(words, key=lambda w: (len(w), w), reverse=True)[:FTS_MAX_TERMS]
+    return " OR ".join(f'"{w}"' for w in longest)
+
+
+def similarity_length_window(length: int) -> tuple:
+    """
+    Диапазон длин, при которых сходство может достичь порога.
+    ratio = 2*M/(a+b) и M <= min(a, b), значит нужно 2*min(a, b)/(a+b) >= LOCAL_SIMILARITY_THRESHOLD.
+    Жаккар длинных текстов не больше min/max числа шинглов, а оно почти пропорционально длине.
+    """
+    if length > LONG_TEXT_THRESHOLD:
+        j = LONG_TEXT_JACCARD_THRESHOLD
+        return math.floor(length * j), math.ceil(length / j)
+    t = LOCAL_SIMILARITY_THRESHOLD
+    return math.floor(length * t / (2 - t)), math.ceil(length * (2 - t) / t)
+
+
+def find_exact_duplicate(digest: bytes):
+    """
+    Ищет работу с тем же нормализованным текстом по индексу хэша (см. prepare_text).
+    Возвращает (автор, internet_score, scanned_at) или None. Автор — тот, кто
+    сдал текст первым; internet_score — результат самого свежего скана Copyleaks,
+    если тот не старше INTERNET_SCORE_TTL, иначе internet_score и scanned_at — None.
+    """
+    if _submission_count == 0:
+        return None
+    with _db_lock:
+        conn = get_db()
+        first = conn.execute(
+            "SELECT user_id, username FROM submissions WHERE text_hash = ? ORDER BY id LIMIT 1",
+            (digest,)
+        ).fetchone()
+        if first is None:
+            return None
+        scan = conn.execute(
+            """
+            SELECT internet_score, scanned_at FROM submissions
+            WHERE text_hash = ? AND scanned_at IS NOT NULL
+            ORDER BY scanned_at DESC
+            LIMIT 1
+            """,
+            (digest,)
+        ).fetchone()
+    user_id, username = first
+    internet_score, scanned_at = scan or (None, None)
+    # Срок отсчитывается от настоящего скана: переиспользование его не продлевает
+    if scanned_at is None or scanned_at < (datetime.utcnow() - timedelta(seconds=INTERNET_SCORE_TTL)).isoformat():
+        internet_score = scanned_at = None
+    return username or str(user_id), internet_score, scanned_at
+
+
+def calculate_max_similarity_locally(norm: str):
+    """
+    Наибольшее сходство нормализованного текста с сохранёнными работами: (сходство, автор),
+    или (0.0, None), если порог не достигнут. Для длинных текстов сходство — Жаккар
+    шинглов из слов (порог LONG_TEXT_JACCARD_THRESHOLD), иначе ratio (LOCAL_SIMILARITY_THRESHOLD).
+    """
+    if _submission_count == 0:
+        # Сравнивать не с чем: не считаем ни подпись, ни запросы к БД
+        return 0.0, None
+    if not LOCAL_SCAN_MIN_LEN <= len(norm) <= LOCAL_SCAN_MAX_LEN:
+        return 0.0, None
+    query = build_fts_query(norm)
+    m = text_minhash(norm)
+    with _db_lock:
+        conn = get_db()
+        # Кандидаты: почти-дубликаты из LSH плюс лучшие совпадения BM25,
+        # только те, чья длина в принципе допускает ratio >= порога
+        min_len, max_len = similarity_length_window(len(norm))
+        candidate_ids = set(_lsh.query(m))
+        if query:
+            candidate_ids.update(row_id for row_id, in conn.execute(
+                """
+                SELECT f.rowid
+                FROM submissions_fts f JOIN submissions s ON s.id = f.rowid
+                WHERE submissions_fts MATCH ? AND s.norm_len BETWEEN ? AND ?
+                ORDER BY bm25(submissions_fts)
+                LIMIT ?
+                """,
+                (query, min_len, max_len, FTS_CANDIDATES_LIMIT)
+            ))
+        if not candidate_ids:
+            return 0.0, None
+        rows = conn.execute(
+            """
+            SELECT s.user_id, s.username, s.norm_text, s.word_shingles
+            FROM json_each(?) AS cand JOIN submissions s ON s.id = cand.value
+            WHERE s.norm_len BETWEEN ? AND ?
+            """,
+            (json.dumps(sorted(candidate_ids)), min_len, max_len)
+        ).fetchall()
+    if not rows:
+        return 0.0, None
+    if len(norm) > LONG_TEXT_THRESHOLD:
+        query_shingles = word_shingle_hashes(norm)
+        best, best_ratio = None, 0.0
+        for i, row in enumerate(rows):
+            shingles = np.frombuffer(row[3], dtype=np.uint64)
+            # Жаккар не больше min(|A|, |B|) / max(|A|, |B|): проверка за O(1)
+            small, large = sorted((query_shingles.size, shingles.size))
+            if small < LONG_TEXT_JACCARD_THRESHOLD * large or small <= best_ratio * large:
+                continue
+            ratio = jaccard(query_shingles, shingles)
+            if ratio >= LONG_TEXT_JACCARD_THRESHOLD and ratio > best_ratio:
+                best, best_ratio = i, ratio
+        if best is None:
+            return 0.0, None
+    else:
+        # Один вызов C++ по всем кандидатам; score_cutoff позволяет RapidFuzz
+        # бросать сверку, как только порог недостижим
+        match = process.extractOne(
+            norm, [row[2] for row in rows], scorer=fuzz.ratio,
+            score_cutoff=LOCAL_SIMILARITY_THRESHOLD * 100
+        )
+        if match is None:
+            return 0.0, None
+        _, score, best = match
+        best_ratio = score / 100.0
+    user_id, username = rows[best][:2]
+    return float(best_ratio), username or str(user_id)
 
 # --------------------------------------------
 #  Извлечение текста из .docx
 # --------------------------------------------
-def extract_text_from_docx(path: str) -> str:
-    with zipfile.ZipFile(path, 'r') as z:
-        xml_content = z.read('word/document.xml')
-    namespace = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-    root = ET.fromstring(xml_content)
-    texts = [node.text for node in root.findall('.//w:t', namespace) if node.text]
+W_T_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t'
+
+
+def extract_text_from_docx(fileobj: BinaryIO) -> str:
+    """
+    Потоково вынимает текст из <w:t>, не строя дерево документа целиком.
+    """
+    texts = []
+    with zipfile.ZipFile(fileobj, 'r') as z, z.open('word/document.xml') as f:
+        for _, node in ET.iterparse(f, events=('end',)):
+            if node.tag == W_T_TAG and node.text:
+                texts.append(node.text)
+            node.clear()
     return "\n".join(texts)
 
 # --------------------------------------------
-#  Copyleaks SDK
+#  Copyleaks API
 # --------------------------------------------
-# Инициализация SDK и логин
-copyleaks = Copyleaks()
-login = copyleaks.login(COPYLEAKS_EMAIL, COPYLEAKS_API_KEY)
-access_token = login.access_token
+COPYLEAKS_ID_URL = "https://id.copyleaks.com"
+COPYLEAKS_API_URL = "https://api.copyleaks.com"
+COPYLEAKS_TOKEN_TTL = 47 * 3600  # токен Copyleaks живёт 48 ч, обновляем с запасом
+COPYLEAKS_TOKEN_REFRESH = 3600  # за сколько до истечения токен обновляет watchdog
+# Ожидание вебхука о завершении скана: интервал растёт от BASE до MAX (сек)
+# в FACTOR раз, после каждого интервала просим Copyleaks переслать вебхук;
+# всего не дольше TIMEOUT (расписание ведёт _watch_scans, обработчики не блокируются)
+COPYLEAKS_POLL_BASE = float(os.getenv("COPYLEAKS_POLL_BASE", "10"))
+COPYLEAKS_POLL_MAX = float(os.getenv("COPYLEAKS_POLL_MAX", "60"))
+COPYLEAKS_POLL_FACTOR = float(os.getenv("COPYLEAKS_POLL_FACTOR", "1.6"))
+COPYLEAKS_SCAN_TIMEOUT = float(os.getenv("COPYLEAKS_SCAN_TIMEOUT", "300"))
+HTTP_TIMEOUT = 30
+WATCHDOG_HTTP_TIMEOUT = 5  # запросы потока watchdog: ждать их долго нельзя
+
+# Одна сессия на процесс: keep-alive и пул соединений вместо TLS-рукопожатия
+# на каждый запрос
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    # 429 и 5xx повторяем с паузой (с учётом Retry-After). POST и PUT тоже:
+    # логин безопасно повторить, а повторный submit с тем же scan_id получит
+    # 409, если первая попытка скан всё-таки создала (см. submit_to_copyleaks)
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST", "PUT"}),
+        raise_on_status=False
+    )
+))
+session.headers.update({"User-Agent": "plag-bot/1.0"})
 
+# Отдельная сессия для запросов единственного потока watchdog (повтор вебхука,
+# плановое обновление токена): пауза по Retry-After задержала бы дедлайны всех
+# сканов. Без ретраев: неудачный запрос watchdog сам повторит по расписанию
+watchdog_session = requests.Session()
+watchdog_session.mount("https://", HTTPAdapter(max_retries=0))
+watchdog_session.headers.update({"User-Agent": "plag-bot/1.0"})
 
-def check_internet_plagiarism(text: str) -> float:
+_token_cache = {"token": None, "exp": 0.0}
+_token_lock = threading.Lock()
+
+# Сканы, ожидающие вебхука Copyleaks: scan_id -> данные работы и расписание
+# повторных запросов вебхука (см. _watch_scans)
+_pending_scans = {}
+# Хэш нормализованного текста -> scan_id идущего скана: тот же текст,
+# присланный до прихода результата, ждёт этот скан, а не запускает новый
+_scans_by_hash = {}
+_pending_lock = threading.Lock()
+_watchdog = None
+
+def get_copyleaks_token(min_ttl: float = 60, http: requests.Session = session,
+                        timeout: float = HTTP_TIMEOUT, wait: bool = True) -> Optional[str]:
     """
-    Проверяет текст через Copyleaks и возвращает % совпадений.
+    Возвращает токен Copyleaks из кэша; логинится при первом обращении
+    и когда до истечения остаётся меньше min_ttl секунд. С wait=False не ждёт
+    логина, который уже идёт в другом потоке, и возвращает None.
     """
-    scan_id = str(uuid.uuid4())
-    props = ScanProperties(
-        sandbox=False,
-        start_scan=True,
-        webhooks=Webhooks(status=[])
-    )
-    source = SourceText(content=text, filename="submission.txt")
-    copyleaks.create_scan_by_text(
-        token=access_token,
-        scan_id=scan_id,
-        properties=props,
-        source=source
+    if not _token_lock.acquire(blocking=wait):
+        return None
+    try:
+        if time.time() >= _token_cache["exp"] - min_ttl:
+            resp = http.post(
+                f"{COPYLEAKS_ID_URL}/v3/account/login/api",
+                json={"email": COPYLEAKS_EMAIL, "key": COPYLEAKS_API_KEY},
+                timeout=timeout
+            )
+            resp.raise_for_status()
+            _token_cache["token"] = resp.json()["access_token"]
+            _token_cache["exp"] = time.time() + COPYLEAKS_TOKEN_TTL
+        return _token_cache["token"]
+    finally:
+        _token_lock.release()
+
+
+def invalidate_copyleaks_token(token: str):
+    """
+    Сбрасывает кэш, если Copyleaks отверг этот токен раньше срока.
+    """
+    with _token_lock:
+        if _token_cache["token"] == token:
+            _token_cache["exp"] = 0.0
+
+
+def copyleaks_request(method: str, url: str, headers: dict = None,
+                      http: requests.Session = session, timeout: float = HTTP_TIMEOUT,
+                      wait: bool = True, **kwargs) -> Optional[requests.Response]:
+    """
+    Запрос к API Copyleaks с токеном из кэша. На 401 (токен отозван) логинится
+    заново и повторяет запрос один раз; остальные статусы проверяет вызывающий.
+    http, timeout и wait относятся и к логину (см. get_copyleaks_token); если
+    токена не дождались, запрос не отправляется и возвращается None.
+    """
+    for attempt in range(2):
+        token = get_copyleaks_token(http=http, timeout=timeout, wait=wait)
+        if token is None:
+            return None
+        resp = http.request(
+            method, url,
+            headers={**(headers or {}), "Authorization": f"Bearer {token}"},
+            timeout=timeout,
+            **kwargs
+        )
+        if resp.status_code != 401 or attempt:
+            return resp
+        invalidate_copyleaks_token(token)
+
+
+def submit_to_copyleaks(scan_id: str, text: str):
+    """
+    Отправляет текст на скан; о результате Copyleaks сообщит вебхуком.
+    """
+    # Тело собирается orjson сразу в bytes: для многомегабайтного base64 это
+    # в разы быстрее json.dumps, которым сериализует requests
+    payload = {
+        "base64": base64.b64encode(text.encode("utf-8")).decode("ascii"),
+        "filename": "submission.txt",
+        "properties": {
+            "sandbox": False,
+            "webhooks": {"status": f"{WEBHOOK_URL}/copyleaks/{scan_id}/{{STATUS}}"}
+        }
+    }
+    resp = copyleaks_request(
+        "PUT",
+        f"{COPYLEAKS_API_URL}/v3/scans/submit/file/{scan_id}",
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"}
     )
-    # SDK ждёт завершения и получает результаты
-    report = copyleaks.get_scan_results(token=access_token, scan_id=scan_id)
-    return report.summary.percentage
+    if resp.status_code == 409:
+        # scan_id — свежий uuid4, так что конфликт означает одно: скан создан
+        # нашей же попыткой, ответ на которую потерялся (5xx), и ретрай упёрся в него
+        logger.warning("Скан %s уже создан, повторная отправка не нужна", scan_id)
+        return
+    resp.raise_for_status()
+
+
+def request_webhook_resend(scan_id: str):
+    """
+    Просит Copyleaks повторить вебхук скана (если наш потерялся). Пока скан
+    не завершён, Copyleaks отвечает ошибкой — это не повод прерывать ожидание.
+    """
+    try:
+        copyleaks_request(
+            "POST", f"{COPYLEAKS_API_URL}/v3/scans/{scan_id}/webhooks/resend",
+            http=watchdog_session, timeout=WATCHDOG_HTTP_TIMEOUT, wait=False
+        )
+    except requests.RequestException as e:
+        logger.warning("Не удалось запросить повтор вебхука %s: %s", scan_id, e)
+    except Exception:
+        # Например, неожиданный ответ на логин: следующий повтор будет по расписанию
+        logger.exception("Сбой при запросе повтора вебхука %s", scan_id)
+
+
+def _jittered(delay: float) -> float:
+    return delay + random.uniform(0, 0.3 * delay)
+
+
+def internet_verdict(score: float) -> str:
+    if score >= INTERNET_SIMILARITY_THRESHOLD:
+        return f"❌ Найдено {score:.1f}% совпадений в интернете."
+    return f"✅ В интернете только {score:.1f}% совпадений."
+
+
+def start_internet_check(bot: Bot, chat_id: int, user_id: int, username: str, text: str, digest: bytes):
+    """
+    Запускает скан Copyleaks и сразу возвращается: ответ пользователю и
+    сохранение работы делает handle_copyleaks_status по вебхуку.
+    Если такой же текст уже сканируется, автор просто добавляется к этому скану.
+    """
+    author = {"chat_id": chat_id, "user_id": user_id, "username": username, "text": text}
+    scan_id = str(uuid.uuid4())
+    now = time.monotonic()
+    # Поиск и регистрация — под одним захватом замка и до загрузки текста:
+    # тот же текст, пришедший во время PUT, присоединится к этому скану
+    with _pending_lock:
+        running = _scans_by_hash.get(digest)
+        if running is not None:
+            _pending_scans[running]["authors"].append(author)
+            return
+        _scans_by_hash[digest] = scan_id
+        _pending_scans[scan_id] = {
+            "hash": digest,
+            "authors": [author],
+            "text": text,
+            "deadline": now + COPYLEAKS_SCAN_TIMEOUT,
+            "delay": COPYLEAKS_POLL_BASE,
+            "next_resend": now + _jittered(COPYLEAKS_POLL_BASE),
+        }
+    try:
+        submit_to_copyleaks(scan_id, text)
+    except Exception as e:
+        with _pending_lock:
+            scan = _pop_scan(scan_id)
+        # Первый автор узнает об ошибке из исключения, присоединившиеся — отсюда
+        for joined in scan["authors"][1:] if scan else []:
+            _notify(bot, joined["chat_id"], f"Ошибка Copyleaks: {e}")
+        raise
+
+
+def _pop_scan(scan_id: str):
+    """
+    Снимает скан с ожидания; вызывается под _pending_lock.
+    """
+    scan = _pending_scans.pop(scan_id, None)
+    if scan is not None and _scans_by_hash.get(scan["hash"]) == scan_id:
+        del _scans_by_hash[scan["hash"]]
+    return scan
+
+
+def _notify(bot: Bot, chat_id: int, text: str):
+    """
+    Сообщение автору скана; сбой отправки (например, бот заблокирован) только
+    логируется, чтобы не сорвать ответы и сохранение остальным авторам.
+    """
+    try:
+        bot.send_message(chat_id, text)
+    except Exception:
+        logger.exception("Не удалось отправить сообщение в чат %s", chat_id)
+
+
+def scan_score(payload) -> Optional[float]:
+    """
+    aggregatedScore из вебхука completed или None, если тело не того вида.
+    """
+    try:
+        return float(payload["results"]["score"]["aggregatedScore"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def scan_error_message(payload: dict) -> str:
+    """
+    Текст ошибки из вебхука error; поле error может быть любого вида.
+    """
+    error = payload.get("error")
+    if isinstance(error, dict) and isinstance(error.get("message"), str):
+        return error["message"]
+    return "ошибка скана"
+
+
+def handle_copyleaks_status(bot: Bot, scan_id: str, status: str, payload: dict):
+    """
+    Принимает вебхук Copyleaks: сообщает результат пользователю и сохраняет работу.
+    """
+    if status not in ("completed", "error"):
+        return
+    if not isinstance(payload, dict):
+        payload = {}
+    # Тело разбираем целиком до снятия скана с ожидания: исключение здесь не
+    # должно терять скан, о котором никто уже не сообщит
+    score, message = None, None
+    if status == "error":
+        message = scan_error_message(payload)
+    else:
+        score = scan_score(payload)
+        if score is None:
+            message = "не удалось прочитать результат скана"
+    with _pending_lock:
+        # Повторно присланный вебхук уже обработанного скана игнорируем
+        scan = _pop_scan(scan_id)
+    if scan is None:
+        return
+    if message is not None:
+        if status == "completed":
+            logger.error("Вебхук completed скана %s без aggregatedScore: %r", scan_id, payload)
+        for author in scan["authors"]:
+            _notify(bot, author["chat_id"], f"Ошибка Copyleaks: {message}")
+        return
+    for author in scan["authors"]:
+        _notify(bot, author["chat_id"], internet_verdict(score))
+        save_submission(author["user_id"], author["username"], author["text"], score)
+
+
+def _watch_scans(bot: Bot):
+    """
+    Следит за ожидающими сканами: по расписанию с экспоненциальным ростом
+    интервала и джиттером просит повторить вебхук, по дедлайну сдаётся.
+    Заодно заранее логинится в Copyleaks, чтобы обработчики не ждали логина.
+    """
+    next_token_check = 0.0
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        # Сбой итерации только логируется: если поток умрёт, никто больше не
+        # сообщит о дедлайнах и не обновит токен, а _pending_scans будет расти
+        try:
+            if now >= next_token_check:
+                next_token_check = now + 60
+                try:
+                    # Без ретраев и без ожидания чужого логина: поток не должен
+                    # застревать, пока у сканов идут дедлайны
+                    get_copyleaks_token(
+                        min_ttl=COPYLEAKS_TOKEN_REFRESH, http=watchdog_session,
+                        timeout=WATCHDOG_HTTP_TIMEOUT, wait=False
+                    )
+                except Exception as e:
+                    logger.warning("Не удалось обновить токен Copyleaks: %s", e)
+            _check_pending_scans(bot, now)
+        except Exception:
+            logger.exception("Сбой в потоке наблюдения за сканами")
+
+
+def _check_pending_scans(bot: Bot, now: float):
+    expired, due = [], []
+    with _pending_lock:
+        for scan_id, scan in list(_pending_scans.items()):
+            if now >= scan["deadline"]:
+                expired.append(_pop_scan(scan_id))
+            elif now >= scan["next_resend"]:
+                scan["delay"] = min(scan["delay"] * COPYLEAKS_POLL_FACTOR, COPYLEAKS_POLL_MAX)
+                scan["next_resend"] = now + _jittered(scan["delay"])
+                due.append(scan_id)
+    # Снятым сканам сообщаем первыми: они уже не в _pending_scans
+    for scan in expired:
+        for author in scan["authors"]:
+            _notify(bot, author["chat_id"], "Ошибка Copyleaks: результат не пришёл вовремя")
+    for scan_id in due:
+        request_webhook_resend(scan_id)
+
+
+def start_scan_watchdog(bot: Bot):
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = threading.Thread(target=_watch_scans, args=(bot,), name="copyleaks-watchdog", daemon=True)
+        _watchdog.start()
 
 # --------------------------------------------
 #  Обработчики Telegram
@@ -142,26 +906,68 @@ def help_cmd(update: Update, context):
     )
 
 
-def check_text(update: Update, context):
-    raw_text = update.message.text.strip()
-    if not raw_text:
-        update.message.reply_text("Пустого текста не принимаю.")
-        return
-    # Локальная проверка
-    ratio, user = calculate_max_similarity_locally(raw_text)
-    if ratio >= LOCAL_SIMILARITY_THRESHOLD:
-        update.message.reply_text(f"⚠ Локальное совпадение: {ratio*100:.1f}% с @{user}")
+def on_error(update, context):
+    """
+    Апдейты обрабатываются уже после ответа Telegram, поэтому любая ошибка
+    обработчика должна попасть в лог и, по возможности, к пользователю.
+    """
+    logger.error("Ошибка при обработке апдейта", exc_info=context.error)
+    if isinstance(update, Update) and update.effective_message:
+        try:
+            update.effective_message.reply_text("Что-то пошло не так, попробуйте ещё раз.")
+        except Exception:
+            logger.exception("Не удалось сообщить пользователю об ошибке")
+
+
+def check_submission(update: Update, context, raw_text: str):
+    """
+    Общая часть обработки текста и .docx: локальная проверка и запуск скана.
+    """
+    norm, digest = prepare_text(raw_text)
+    duplicate = find_exact_duplicate(digest)
+    if duplicate:
+        user, internet_score, scanned_at = duplicate
+        update.message.reply_text(f"⚠ Локальное совпадение: 100.0% с @{user}")
+        if internet_score is not None:
+            # Этот текст недавно сканировался: повторный скан Copyleaks ничего не даст
+            update.message.reply_text(internet_verdict(internet_score))
+            save_submission(
+                update.effective_user.id,
+                update.effective_user.username or "",
+                raw_text,
+                internet_score,
+                scanned_at
+            )
+            return
+    else:
+        similarity, user = calculate_max_similarity_locally(norm)
+        if user is not None and len(norm) > LONG_TEXT_THRESHOLD:
+            # Жаккар — доля общих фрагментов, на посимвольный процент он не похож
+            update.message.reply_text(
+                f"⚠ Локальное совпадение: {similarity*100:.1f}% общих фрагментов текста с @{user}"
+            )
+        elif user is not None:
+            update.message.reply_text(f"⚠ Локальное совпадение: {similarity*100:.1f}% с @{user}")
     update.message.reply_text("Проверяю по интернету...")
     try:
-        internet_score = check_internet_plagiarism(raw_text)
+        start_internet_check(
+            context.bot,
+            update.effective_chat.id,
+            update.effective_user.id,
+            update.effective_user.username or "",
+            raw_text,
+            digest
+        )
     except Exception as e:
         update.message.reply_text(f"Ошибка Copyleaks: {e}")
+
+
+def check_text(update: Update, context):
+    raw_text = update.message.text.strip()
+    if not raw_text:
+        update.message.reply_text("Пустого текста не принимаю.")
         return
-    if internet_score >= INTERNET_SIMILARITY_THRESHOLD:
-        update.message.reply_text(f"❌ Найдено {internet_score:.1f}% совпадений в интернете.")
-    else:
-        update.message.reply_text(f"✅ В интернете только {internet_score:.1f}% совпадений.")
-    save_submission(update.effective_user.id, update.effective_user.username or "", raw_text, internet_score)
+    check_submission(update, context, raw_text)
 
 
 def handle_document(update: Update, context):
@@ -170,54 +976,82 @@ def handle_document(update: Update, context):
         update.message.reply_text("Только .docx")
         return
     new_file = context.bot.get_file(doc.file_id)
-    with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as tf:
-        path = tf.name
-        new_file.download(custom_path=path)
-    raw_text = extract_text_from_docx(path)
-    os.remove(path)
-    # Локальная проверка
-    ratio, user = calculate_max_similarity_locally(raw_text)
-    if ratio >= LOCAL_SIMILARITY_THRESHOLD:
-        update.message.reply_text(f"⚠ Локальное совпадение: {ratio*100:.1f}% с @{user}")
-    update.message.reply_text("Проверяю по интернету...")
-    try:
-        internet_score = check_internet_plagiarism(raw_text)
-    except Exception as e:
-        update.message.reply_text(f"Ошибка Copyleaks: {e}")
-        return
-    if internet_score >= INTERNET_SIMILARITY_THRESHOLD:
-        update.message.reply_text(f"❌ Найдено {internet_score:.1f}% совпадений в интернете.")
-    else:
-        update.message.reply_text(f"✅ В интернете только {internet_score:.1f}% совпадений.")
-    save_submission(update.effective_user.id, update.effective_user.username or "", raw_text, internet_score)
+    # Файл скачивается в память и читается оттуда, без временного файла на диске
+    buf = io.BytesIO()
+    new_file.download(out=buf)
+    buf.seek(0)
+    raw_text = extract_text_from_docx(buf)
+    check_submission(update, context, raw_text)
 
 # --------------------------------------------
 #  Flask + Webhook
 # --------------------------------------------
-app = Flask(__name__)
-bot = Bot(token=TOKEN)
-dispatcher = Dispatcher(bot, None, workers=4, use_context=True)
-
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('help', help_cmd))
-dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, check_text))
-dispatcher.add_handler(MessageHandler(Filters.document, handle_document))
-
-@app.route('/', methods=['GET'])
-def root():
-    return 'Bot is running', 200
-
-@app.route(f'/{TOKEN}', methods=['POST'])
-def webhook():
-    data = request.get_json(force=True)
-    update = Update.de_json(data, bot)
-    dispatcher.process_update(update)
-    return 'OK', 200
+def read_json_body():
+    """
+    Тело входящего вебхука как JSON: orjson разбирает bytes сразу, без
+    промежуточной str, как у request.get_json.
+    """
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400)
 
-if __name__ == '__main__':
-    init_db()
+
+def create_app() -> Flask:
+    """
+    Собирает приложение: БД, бот, Dispatcher, маршруты и регистрация вебхука.
+    Импорт модуля ничего не открывает — всё происходит здесь, в процессе воркера.
+    """
     if not all([TOKEN, WEBHOOK_URL, COPYLEAKS_EMAIL, COPYLEAKS_API_KEY]):
-        logger.error('Не заданы все переменные окружения')
-        exit(1)
+        raise RuntimeError('Не заданы все переменные окружения')
+    init_db()
+
+    bot = Bot(token=TOKEN)
+    # Апдейты выполняет update_executor через process_update, run_async не
+    # используется — собственные потоки Dispatcher не нужны. Предупреждение PTB
+    # о том, что без потоков run_async не работает, к нам не относится
+    with warnings.catch_warnings():
+        warnings.filterwarnings(
+            "ignore",
+            message="Asynchronous callbacks can not be processed without at least one worker thread",
+            category=UserWarning
+        )
+        dispatcher = Dispatcher(bot, None, workers=0, use_context=True)
+    dispatcher.add_handler(CommandHandler('start', start))
+    dispatcher.add_handler(CommandHandler('help', help_cmd))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, check_text))
+    dispatcher.add_handler(MessageHandler(Filters.document, handle_document))
+    dispatcher.add_error_handler(on_error)
+    # Обработка апдейтов вне HTTP-потока: Telegram получает 200 сразу
+    update_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="update")
+    start_scan_watchdog(bot)
+
+    app = Flask(__name__)
+
+    @app.route('/', methods=['GET'])
+    def root():
+        return 'Bot is running', 200
+
+    @app.route(f'/{TOKEN}', methods=['POST'])
+    def webhook():
+        update = Update.de_json(read_json_body(), bot)
+        update_executor.submit(dispatcher.process_update, update)
+        return 'OK', 200
+
+    @app.route('/copyleaks/<scan_id>/<status>', methods=['POST'])
+    def copyleaks_webhook(scan_id, status):
+        handle_copyleaks_status(bot, scan_id, status, read_json_body())
+        return 'OK', 200
+
     bot.set_webhook(f"{WEBHOOK_URL}/{TOKEN}")
+    return app
+
+
+if __name__ == '__main__':
+    # Только для локального запуска; в продакшене: gunicorn (см. gunicorn.conf.py)
+    try:
+        app = create_app()
+    except RuntimeError as e:
+        logger.error(e)
+        exit(1)
     app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,15 @@
+# Запуск: gunicorn (этот файл gunicorn подхватывает сам)
+import os
+
+# Фабрика вызывается в воркере после fork: потоки бота и соединение с БД
+# создаются там, где будут работать
+wsgi_app = "bot:create_app()"
+bind = f"0.0.0.0:{os.getenv('PORT', '8443')}"
+# Потоковые воркеры: вебхук Telegram отвечает сразу, апдейты обрабатывает
+# пул потоков бота, поэтому нескольких потоков на соединения достаточно.
+# Воркер один: LSH-индекс, поток записи в БД и ожидающие сканы Copyleaks
+# живут внутри процесса — вебхук скана должен прийти туда же, где его ждут.
+worker_class = "gthread"
+workers = 1
+threads = 8
+timeout = 60
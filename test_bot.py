@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text):
+        self.replies.append(text)
+
+
+def make_update(user_id: int, username: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        message=FakeMessage(),
+        effective_user=SimpleNamespace(id=user_id, username=username),
+        effective_chat=SimpleNamespace(id=user_id),
+    )
+
+
+class ExactDuplicateTest(unittest.TestCase):
+    TEXT = "Александр Сергеевич Пушкин родился в Москве в семье дворян"
+
+    def setUp(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        os.chdir(tmp.name)
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(os.chdir, cwd)
+        # Свежая БД и индексы на каждый тест; поток записи не запускаем —
+        # очередь сбрасывается вручную через flush()
+        bot._db = None
+        bot._submission_count = 0
+        bot._lsh = bot.MinHashLSH(threshold=bot.LSH_THRESHOLD, num_perm=bot.MINHASH_NUM_PERM)
+        self.addCleanup(self.close_db)
+        bot._init_schema(bot.get_db())
+        # Очередь записи общая на модуль: дописываем её до закрытия БД
+        self.addCleanup(self.flush)
+
+    def close_db(self):
+        bot._db.close()
+        bot._db = None
+
+    def flush(self):
+        while bot._drain_write_queue(block=False) > 0:
+            pass
+
+    def test_reused_score_does_not_extend_ttl(self):
+        scanned_at = (datetime.utcnow() - timedelta(hours=23)).isoformat()
+        bot.save_submission(1, "alice", self.TEXT, 12.5, scanned_at)
+        self.flush()
+
+        # Скан 23 ч назад при сроке 24 ч ещё годен: результат переиспользуется
+        update = make_update(2, "bob")
+        with mock.patch.object(bot, "start_internet_check") as start_check:
+            bot.check_submission(update, SimpleNamespace(bot=None), self.TEXT)
+        start_check.assert_not_called()
+        self.assertIn(bot.internet_verdict(12.5), update.message.replies)
+        self.flush()
+
+        # Повторная отправка не обновила время скана: при сроке 1 ч он устарел
+        _, digest = bot.prepare_text(self.TEXT)
+        with mock.patch.object(bot, "INTERNET_SCORE_TTL", 3600):
+            _, internet_score, _ = bot.find_exact_duplicate(digest)
+        self.assertIsNone(internet_score)
+
+    def test_duplicate_credits_first_author(self):
+        bot.save_submission(1, "alice", self.TEXT, 12.5)
+        self.flush()
+        bot.save_submission(2, "bob", self.TEXT, 12.5)
+        self.flush()
+
+        update = make_update(3, "carol")
+        with mock.patch.object(bot, "start_internet_check"):
+            bot.check_submission(update, SimpleNamespace(bot=None), self.TEXT)
+        self.assertEqual(update.message.replies[0], "⚠ Локальное совпадение: 100.0% с @alice")
+
+
+
+class CopyleaksWebhookTest(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.bot = SimpleNamespace(send_message=lambda chat_id, text: self.sent.append((chat_id, text)))
+
+    def add_scan(self, scan_id: str, chat_id: int):
+        with bot._pending_lock:
+            bot._pending_scans[scan_id] = {
+                "hash": scan_id.encode(),
+                "authors": [{"chat_id": chat_id, "user_id": chat_id, "username": "", "text": "t"}],
+            }
+            bot._scans_by_hash[scan_id.encode()] = scan_id
+
+    def test_malformed_bodies_reach_the_author(self):
+        self.add_scan("s1", 1)
+        self.add_scan("s2", 2)
+        bot.handle_copyleaks_status(self.bot, "s1", "error", {"error": "boom"})
+        with self.assertLogs(bot.logger, "ERROR"):
+            bot.handle_copyleaks_status(self.bot, "s2", "completed", {"results": {}})
+        self.assertEqual(self.sent, [
+            (1, "Ошибка Copyleaks: ошибка скана"),
+            (2, "Ошибка Copyleaks: не удалось прочитать результат скана"),
+        ])
+        self.assertEqual(bot._pending_scans, {})
+        self.assertEqual(bot._scans_by_hash, {})
+
+
+if __name__ == "__main__":
+    unittest.main()